@@ -2,7 +2,6 @@ import asyncio
 import hashlib
 import inspect
 import io
-import json
 import logging
 import os
 import random
@@ -11,15 +10,16 @@ import subprocess
 import textwrap
 import traceback
 import warnings
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Any, Dict, Optional, Tuple
 
 import discord
 import httpx
-import pydantic
-from bs4 import BeautifulSoup
+import orjson
 from discord.ext import commands, pages, tasks
+from lxml import etree, html
 
 from config import guilds
 
@@ -45,66 +45,151 @@ except ImportError:
 
 LTR = "\N{black rightwards arrow}\U0000fe0f"
 RTL = "\N{leftwards black arrow}\U0000fe0f"
-
-
-class MessagePayload(pydantic.BaseModel):
-    class MessageAttachmentPayload(pydantic.BaseModel):
+_ATOM_NS = "{http://www.w3.org/2005/Atom}"
+_MAX_REPLY_DEPTH = 8
+
+_WORD_SPLIT_RE = re.compile(r"\s+")
+_TWITTER_RE = re.compile(r"(^|\W+)twitter", re.IGNORECASE)
+# (trigger words, asset file name) - checked in order, the first match is the one replied with.
+_RESPONSES: tuple[tuple[frozenset[str], str], ...] = (
+    (frozenset(("lupupa",)), "lupupa.jpg"),
+    (frozenset(("fedora", "nix", "nixos")), "fedora.jpg"),
+    (frozenset(("carat",)), "carat.jpg"),
+    (frozenset(("boris",)), "boris.jpg"),
+)
+# trigger word -> index into _RESPONSES, so a message's words can be matched in a single set intersection
+_RESPONSE_INDEX: dict[str, int] = {word: n for n, (triggers, _) in enumerate(_RESPONSES) for word in triggers}
+# cheap substring check - a message containing none of these can't trigger any response
+_RESPONSE_PREFILTER: tuple[str, ...] = (*_RESPONSE_INDEX, "twitter")
+
+
+@dataclass(slots=True)
+class MessagePayload:
+    @dataclass(slots=True)
+    class MessageAttachmentPayload:
         url: str
         proxy_url: str
         filename: str
         size: int
+        content_type: str
         width: Optional[int] = None
         height: Optional[int] = None
-        content_type: str
 
-    event_type: str = "create"
     message_id: int
     author: str
-    is_automated: bool = False
     avatar: str
     content: str
     clean_content: str
     at: float
-    attachments: list[MessageAttachmentPayload] = []
+    event_type: str = "create"
+    is_automated: bool = False
+    attachments: list[MessageAttachmentPayload] = field(default_factory=list)
     reply_to: Optional["MessagePayload"] = None
 
 
+def _build_payload(message: discord.Message) -> MessagePayload:
+    payload = MessagePayload(
+        message_id=message.id,
+        author=message.author.display_name,
+        is_automated=message.author.bot or message.author.system,
+        avatar=message.author.display_avatar.with_static_format("webp").with_size(512).url,
+        content=message.content or "",
+        clean_content=str(message.clean_content or ""),
+        at=message.created_at.timestamp(),
+    )
+    for attachment in message.attachments:
+        payload.attachments.append(
+            MessagePayload.MessageAttachmentPayload(
+                url=attachment.url,
+                filename=attachment.filename,
+                proxy_url=attachment.proxy_url,
+                size=attachment.size,
+                width=attachment.width,
+                height=attachment.height,
+                content_type=attachment.content_type,
+            )
+        )
+    return payload
+
+
+def _generate_payload(message: discord.Message, max_depth: int = _MAX_REPLY_DEPTH) -> MessagePayload:
+    """Builds the payload for a message, including at most max_depth cached messages of its reply chain."""
+    chain = [message]
+    while len(chain) <= max_depth:
+        reference = chain[-1].reference
+        if reference is None or not reference.cached_message:
+            break
+        chain.append(reference.cached_message)
+
+    # build from the oldest message in the chain forwards, so each payload can point at the one it replied to
+    payload = None
+    for _message in reversed(chain):
+        _payload = _build_payload(_message)
+        _payload.reply_to = payload
+        payload = _payload
+    return payload
+
+
+def _file_digest(file: Path) -> str:
+    """Returns the first 32 characters of the file's sha256 hex digest."""
+    with file.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()[:32]
+
+
+# guild ID -> lock, so overlapping disconnect requests for the same voice client only disconnect once
+_dc_locks: dict[int, asyncio.Lock] = {}
+
+
 async def _dc(client: discord.VoiceClient | None):
     if client is None:
         return
-    if client.is_playing():
-        client.stop()
-    try:
+    async with _dc_locks.setdefault(client.guild.id, asyncio.Lock()):
+        # another call already disconnected this client while we were waiting for the lock
+        if client.guild.voice_client is not client:
+            return
+        if client.is_playing():
+            client.stop()
         await client.disconnect(force=True)
-    finally:
-        # client.cleanup()
-        pass
 
 
 class Events(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.http = httpx.AsyncClient()
+        self.http = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60),
+            timeout=httpx.Timeout(15.0),
+        )
         if not hasattr(self.bot, "bridge_queue") or self.bot.bridge_queue.empty():
             self.bot.bridge_queue = asyncio.Queue()
         self.fetch_discord_atom_feed.start()
         self.bridge_health = False
         self.log = logging.getLogger("jimmy.cogs.events")
+        self.assets = Path.cwd() / "assets"
+        # snapshot of the asset file names, so on_message doesn't stat() the filesystem for every response
+        self._present_assets: frozenset[str] = frozenset(
+            file.name for file in self.assets.iterdir() if file.is_file()
+        ) if self.assets.is_dir() else frozenset()
 
     def cog_unload(self):
         self.fetch_discord_atom_feed.cancel()
+        self.bot.loop.create_task(self.http.aclose())
 
     @commands.Cog.listener("on_raw_reaction_add")
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        channel: Optional[discord.TextChannel] = self.bot.get_channel(payload.channel_id)
-        if channel is not None:
+        if payload.emoji.name != "\N{wastebasket}\U0000fe0f":
+            return
+        message: Optional[discord.Message] = self.bot.get_message(payload.message_id)
+        if message is None:
+            channel: Optional[discord.TextChannel] = self.bot.get_channel(payload.channel_id)
+            if channel is None:
+                return
             try:
-                message: discord.Message = await channel.fetch_message(payload.message_id)
+                message = await channel.fetch_message(payload.message_id)
             except discord.HTTPException:
                 return
-            if payload.emoji.name == "\N{wastebasket}\U0000fe0f":
-                if message.author.bot:
-                    await message.delete(delay=0.25)
+        if message.author.bot:
+            await message.delete(delay=0.25)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
@@ -146,70 +231,31 @@ class Events(commands.Cog):
             return
 
         if message.channel.name == "femboy-hole":
-            def generate_payload(_message: discord.Message) -> MessagePayload:
-                _payload = MessagePayload(
-                    message_id=_message.id,
-                    author=_message.author.display_name,
-                    is_automated=_message.author.bot or _message.author.system,
-                    avatar=_message.author.display_avatar.with_static_format("webp").with_size(512).url,
-                    content=_message.content or "",
-                    clean_content=str(_message.clean_content or ""),
-                    at=_message.created_at.timestamp(),
-                )
-                for attachment in _message.attachments:
-                    _payload.attachments.append(
-                        MessagePayload.MessageAttachmentPayload(
-                            url=attachment.url,
-                            filename=attachment.filename,
-                            proxy_url=attachment.proxy_url,
-                            size=attachment.size,
-                            width=attachment.width,
-                            height=attachment.height,
-                            content_type=attachment.content_type,
-                        )
-                    )
-                if _message.reference is not None and _message.reference.cached_message:
-                    try:
-                        _payload.reply_to = generate_payload(_message.reference.cached_message)
-                    except RecursionError:
-                        _payload.reply_to = None
-                        logging.warning("Failed to generate reply payload for message %s", _message.id, exc_info=True)
-                return _payload
-
-            payload = generate_payload(message)
+            payload = _generate_payload(message)
             if message.author != self.bot.user and (payload.content or payload.attachments):
-                await self.bot.bridge_queue.put(payload.model_dump())
+                await self.bot.bridge_queue.put(orjson.dumps(payload))
 
         if message.channel.name in ("verify", "timetable") and message.author != self.bot.user:
             if message.channel.permissions_for(message.guild.me).manage_messages:
                 await message.delete(delay=1)
 
-        if message.content and message.author.bot is False:
-            assets = Path.cwd() / "assets"
-            words = re.split(r"\s+", message.content)
-            words = tuple(map(str.lower, words))
-            if "lupupa" in words and (file := assets / "lupupa.jpg").exists():
-                await message.reply(file=discord.File(file), delete_after=60)
-            elif any(word in words for word in ("fedora", "nix", "nixos")) and (file := assets / "fedora.jpg").exists():
-                await message.reply(file=discord.File(file), delete_after=60)
-            elif "carat" in words and (file := assets / "carat.jpg").exists():
-                await message.reply(file=discord.File(file), delete_after=60)
-            elif "boris" in words and (file := assets / "boris.jpg").exists():
-                await message.reply(file=discord.File(file), delete_after=60)
-            elif "twitter" in message.content.lower():
-                new_content = re.sub(
-                    r"(^|\W+)twitter",
-                    lambda m: f'~~{m.group()}~~ \U0001D54F',
-                    message.content,
-                    flags=re.IGNORECASE
-                )
+        # everything below is a reply to a user, so bot/system messages and empty messages can stop here
+        if message.author.bot or message.author.system or not message.content:
+            return
+
+        lowered = message.content.lower()
+        if not any(trigger in lowered for trigger in _RESPONSE_PREFILTER):
+            return
+        words = frozenset(_WORD_SPLIT_RE.split(lowered))
+        for index in sorted({_RESPONSE_INDEX[word] for word in _RESPONSE_INDEX.keys() & words}):
+            if (filename := _RESPONSES[index][1]) in self._present_assets:
+                await message.reply(file=discord.File(self.assets / filename), delete_after=60)
+                break
+        else:
+            if "twitter" in lowered:
+                new_content = _TWITTER_RE.sub(lambda m: f'~~{m.group()}~~ \U0001D54F', message.content)
                 if len(new_content) > 2000:
-                    new_content = re.sub(
-                        r"(^|\W+)twitter",
-                        '\U0001D54F',
-                        message.content,
-                        flags=re.IGNORECASE
-                    )
+                    new_content = _TWITTER_RE.sub('\U0001D54F', message.content)
                 new_content = new_content.replace("vxtwitter", "fixupx")
                 await message.reply(new_content, delete_after=300)
 
@@ -229,7 +275,7 @@ class Events(commands.Cog):
                     at=(after.edited_at or after.created_at).timestamp(),
                     event_type="edit"
                 )
-                await self.bot.bridge_queue.put(_payload.model_dump())
+                await self.bot.bridge_queue.put(orjson.dumps(_payload))
 
     @commands.Cog.listener("on_message_delete")
     async def on_message_delete(self, message: discord.Message):
@@ -246,7 +292,7 @@ class Events(commands.Cog):
                 at=message.created_at.timestamp(),
                 event_type="redact"
             )
-            await self.bot.bridge_queue.put(_payload.model_dump())
+            await self.bot.bridge_queue.put(orjson.dumps(_payload))
 
     @tasks.loop(minutes=10)
     async def fetch_discord_atom_feed(self):
@@ -270,11 +316,7 @@ class Events(commands.Cog):
         else:
             # calculate the sha256 hash of the file, returning the first 32 characters
             # this is used to check if the file has changed
-            _hash = hashlib.sha256()
-            with file.open("rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    _hash.update(chunk)
-            _hash = _hash.hexdigest()[:32]
+            _hash = await self.bot.loop.run_in_executor(None, _file_digest, file)
             headers["If-None-Match"] = f'W/"{_hash}"'
             last_modified = datetime.fromtimestamp(file.stat().st_mtime, tz=timezone.utc)
 
@@ -299,26 +341,24 @@ class Events(commands.Cog):
             incidents_file.parent.mkdir(parents=True, exist_ok=True)
             incidents = {}
         else:
-            with incidents_file.open("r") as f:
-                incidents = json.load(f)
-
-        soup = BeautifulSoup(response.content, "lxml-xml")
-        for entry in soup.find_all("entry"):
-            published_tag = entry.find("published")
-            updated_tag = entry.find("updated") or published_tag
-            published = datetime.fromisoformat(published_tag.text)
-            updated = datetime.fromisoformat(updated_tag.text)
+            with incidents_file.open("rb") as f:
+                incidents = orjson.loads(f.read())
+        incidents_changed = False
+
+        for _, entry in etree.iterparse(io.BytesIO(response.content), tag=_ATOM_NS + "entry"):
+            published_text = entry.findtext(_ATOM_NS + "published")
+            published = datetime.fromisoformat(published_text)
+            updated = datetime.fromisoformat(entry.findtext(_ATOM_NS + "updated") or published_text)
             if updated > last_modified:
-                title = entry.title.text
+                title = entry.findtext(_ATOM_NS + "title")
+                link = entry.find(_ATOM_NS + "link").get("href")
+                entry_id = entry.findtext(_ATOM_NS + "id")
                 content = ""
-                soup2 = BeautifulSoup(entry.content.text, "html.parser")
-                sep = os.urandom(16).hex()
-                for br in soup2.find_all("br"):
-                    br.replace_with(sep)
-                for _tag in soup2.find_all("p"):
-                    text = _tag.get_text()
-                    date, _content = text.split(sep, 1)
-                    _content = _content.replace(sep, "\n")
+                body = html.fragment_fromstring(entry.findtext(_ATOM_NS + "content"), create_parent="div")
+                for br in body.iter("br"):
+                    br.tail = "\n" + (br.tail or "")
+                for _tag in body.iter("p"):
+                    date, _content = _tag.text_content().split("\n", 1)
                     date = re.sub(r"\s{2,}", " ", date)
                     try:
                         date = datetime.strptime(date, "%b %d, %H:%M PDT")
@@ -341,10 +381,10 @@ class Events(commands.Cog):
                 colour = _status.get(content.splitlines()[1].split(" - ")[0].lower(), discord.Color.greyple())
 
                 if len(content) > 4096:
-                    content = f"[open on discordstatus.com (too large to display)]({entry.link['href']})"
+                    content = f"[open on discordstatus.com (too large to display)]({link})"
 
                 embed = discord.Embed(
-                    title=title, description=content, color=colour, url=entry.link["href"], timestamp=updated
+                    title=title, description=content, color=colour, url=link, timestamp=updated
                 )
                 embed.set_author(
                     name="Discord Status",
@@ -354,24 +394,32 @@ class Events(commands.Cog):
                 )
                 embed.set_footer(
                     text="Published: {} | Updated: {}".format(
-                        datetime.fromisoformat(entry.find("published").text).strftime("%Y-%m-%d %H:%M:%S"),
+                        published.strftime("%Y-%m-%d %H:%M:%S"),
                         updated.strftime("%Y-%m-%d %H:%M:%S"),
                     )
                 )
 
-                if entry.id.text not in incidents:
+                if entry_id not in incidents:
                     msg = await channel.send(embed=embed)
-                    incidents[entry.id.text] = msg.id
+                    incidents[entry_id] = msg.id
+                    incidents_changed = True
                 else:
                     try:
-                        msg = await channel.fetch_message(incidents[entry.id.text])
+                        msg = await channel.fetch_message(incidents[entry_id])
                         await msg.edit(embed=embed)
                     except discord.HTTPException:
                         msg = await channel.send(embed=embed)
-                        incidents[entry.id.text] = msg.id
-
-        with incidents_file.open("w") as f:
-            json.dump(incidents, f, separators=(",", ":"))
+                        incidents[entry_id] = msg.id
+                        incidents_changed = True
+            # entries are parsed one at a time, so drop each one once it has been handled
+            entry.clear()
+
+        if incidents_changed:
+            # write to a temporary file and swap it in, so a crash mid-write can't leave a truncated history
+            tmp_file = incidents_file.with_suffix(".tmp")
+            with tmp_file.open("wb") as f:
+                f.write(orjson.dumps(incidents))
+            os.replace(tmp_file, incidents_file)
 
 
 def setup(bot):
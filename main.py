@@ -12,6 +12,15 @@ from rich.logging import RichHandler
 
 import config
 from utils import JimmyBanException, JimmyBans, console, get_or_none
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+else:
+    # Must be set before the bot (and with it, the event loop) is created in utils.client.
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 from utils.client import bot
 
 logging.basicConfig(
@@ -0,0 +1,49 @@
+import random
+
+import pytest
+from discord.ext.commands import Paginator
+
+from utils import line_paginator
+
+MAX_SIZE = 1990
+
+
+def baseline_pages(text: str) -> list[str]:
+    """The /bridge pagination before line_paginator: one add_line call per line."""
+    paginator = Paginator(prefix="", suffix="", max_size=MAX_SIZE)
+    for line in text.splitlines():
+        paginator.add_line(line)
+    return paginator.pages
+
+
+def random_message(rng: random.Random, max_line_length: int) -> str:
+    lines = []
+    for _ in range(rng.randint(1, 12)):
+        length = rng.choice((0, 5, 80, 400, 900, 1500, max_line_length))
+        lines.append("".join(rng.choice("abc ") for _ in range(rng.randint(0, length))))
+    return "\n".join(lines)[:4000]
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_pages_match_baseline(seed: int):
+    rng = random.Random(seed)
+    text = random_message(rng, MAX_SIZE - 2)
+    assert line_paginator(text, max_size=MAX_SIZE).pages == baseline_pages(text)
+
+
+def test_single_short_message():
+    assert line_paginator("hello\nworld", max_size=MAX_SIZE).pages == ["\nhello\nworld\n"]
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_long_lines_are_shortened(seed: int):
+    rng = random.Random(seed)
+    text = random_message(rng, 3999)
+    pages = line_paginator(text, max_size=MAX_SIZE).pages
+    assert all(len(page) <= MAX_SIZE for page in pages)
+
+
+def test_overlong_line_gets_placeholder():
+    pages = line_paginator("word " * 800, max_size=MAX_SIZE).pages
+    assert len(pages) == 1
+    assert pages[0].rstrip("\n").endswith("<...>")
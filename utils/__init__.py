@@ -1,3 +1,4 @@
+import textwrap
 import time
 from typing import TYPE_CHECKING, Optional
 from urllib.parse import urlparse
@@ -79,6 +80,18 @@ def simple_embed_paginator(
     return embeds
 
 
+def line_paginator(text: str, *, max_size: int = 2000) -> commands.Paginator:
+    """Paginates text line by line, with no prefix/suffix. Lines too long to fit on a page are shortened."""
+    paginator = commands.Paginator(prefix="", suffix="", max_size=max_size)
+    # the longest line add_line accepts: max_size minus the two line separators
+    max_line_length = max_size - 2
+    for line in text.splitlines():
+        if len(line) > max_line_length:
+            line = textwrap.shorten(line, width=max_size - 10, placeholder="<...>")
+        paginator.add_line(line)
+    return paginator
+
+
 def hyperlink(url: str, *, text: str = None, max_length: int = None) -> str:
     if max_length < len(url):
         raise ValueError(f"Max length ({max_length}) is too low for provided URL ({len(url)}). Hyperlink impossible.")
@@ -1,27 +1,29 @@
 import asyncio
+import hmac
 import ipaddress
 import logging
 import os
-import textwrap
 import secrets
+import time
 from asyncio import Lock
+from collections import OrderedDict
 from datetime import datetime, timezone
 from hashlib import sha512
 from http import HTTPStatus
 from pathlib import Path
 from typing import Optional, Annotated
-from discord.ext.commands import Paginator
 
 import discord
 import httpx
+import orjson
 from fastapi import FastAPI, HTTPException, Request, status, Depends, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials as HTTPAuthCreds
 from fastapi import WebSocketException as _WSException
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse
 from starlette.websockets import WebSocket, WebSocketDisconnect
 from websockets.exceptions import WebSocketException
 
-from utils import get_or_none, BridgeBind
+from utils import get_or_none, line_paginator, BridgeBind
 from utils.db import AccessTokens
 
 SF_ROOT = Path(__file__).parent / "static"
@@ -44,14 +46,39 @@ except ImportError:
 log = logging.getLogger("jimmy.api")
 
 GENERAL = "https://discord.com/channels/994710566612500550/"
+STATE_TTL = 300
+MAX_STATES = 10_000
+BRIDGE_BATCH_SIZE = 32
+BRIDGE_MAX_BODY = 64 * 1024
+
+# Sent once /auth completes. Built and encoded once here, as it never changes.
+AUTH_REDIRECT_HTML = f"""
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Redirecting...</title>
+</head>
+<body>
+    <script>
+        window.location.href = "{GENERAL}";
+    </script>
+    <noscript>
+        <meta http-equiv="refresh" content="0; url={GENERAL}" />
+    </noscript>
+    <p>Redirecting you to the general channel...</p>
+    <i><a href='{GENERAL}' rel='noopener'>Click here if you are not redirected.</a></i>
+</body>
+</html>
+""".encode()
 
 OAUTH_ENABLED = OAUTH_ID and OAUTH_SECRET and OAUTH_REDIRECT_URI
 
-app = FastAPI(root_path=WEB_ROOT_PATH)
+app = FastAPI(root_path=WEB_ROOT_PATH, default_response_class=ORJSONResponse)
 app.state.bot = None
-app.state.states = {}
+# state -> time.monotonic() when it was issued. Insertion order is issue order, so expired states are at the front.
+app.state.states = OrderedDict()
 app.state.binds = {}
-app.state.http = httpx.Client()
+app.state.http = httpx.AsyncClient(timeout=10.0)
 security = HTTPBearer()
 
 if StaticFiles:
@@ -66,15 +93,42 @@ except ImportError:
 app.state.last_sender = None
 app.state.last_sender_ts = datetime.utcnow()
 app.state.ws_connected = Lock()
+app.state.bridge_pending = []
+
+
+async def drain_batch(queue: asyncio.Queue, max_items: int = BRIDGE_BATCH_SIZE, timeout: float = None) -> list:
+    """Waits (up to timeout seconds) for one item, then takes whatever else is already queued, up to max_items."""
+    items = [await asyncio.wait_for(queue.get(), timeout=timeout)]
+    while len(items) < max_items:
+        try:
+            items.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return items
+
+
+def expire_states():
+    """Drops OAuth states older than STATE_TTL seconds, oldest first, and makes room for one more under MAX_STATES."""
+    states: OrderedDict = app.state.states
+    now = time.monotonic()
+    while states and now - next(iter(states.values())) > STATE_TTL:
+        states.popitem(last=False)
+    while len(states) >= MAX_STATES:
+        states.popitem(last=False)
+
+
+def is_bot_token(value: Optional[str]) -> bool:
+    """Checks a secret against the bot's token in constant time."""
+    return hmac.compare_digest((value or "").encode(), app.state.bot.http.token.encode())
 
 
 async def is_authenticated(credentials: Annotated[HTTPAuthCreds, Depends(security)]):
-    if credentials.credentials != app.state.bot.http.token:
+    if not is_bot_token(credentials.credentials):
         raise HTTPException(status_code=401, detail="Invalid secret.")
 
 
 async def get_access_token(code: str, redirect_uri: str = OAUTH_REDIRECT_URI):
-    response = app.state.http.post(
+    response = await app.state.http.post(
         "https://discord.com/api/oauth2/token",
         data={
             "grant_type": "authorization_code",
@@ -89,7 +143,7 @@ async def get_access_token(code: str, redirect_uri: str = OAUTH_REDIRECT_URI):
 
 
 async def get_authorised_user(access_token: str):
-    response = app.state.http.get(
+    response = await app.state.http.get(
         "https://discord.com/api/users/@me",
         headers={"Authorization": "Bearer " + access_token}
     )
@@ -97,15 +151,20 @@ async def get_authorised_user(access_token: str):
     return response.json()
 
 
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
+
 @app.middleware("http")
 async def check_bot_instanced(request, call_next):
     if not request.app.state.bot:
-        return JSONResponse(status_code=503, content={"message": "Not ready."}, headers={"Retry-After": "10"})
+        return ORJSONResponse(status_code=503, content={"message": "Not ready."}, headers={"Retry-After": "10"})
     return await call_next(request)
 
 
 @app.get("/ping")
-def ping():
+async def ping():
     bot_started = datetime.now(tz=timezone.utc) - app.state.bot.started_at
     return {
         "ping": "pong",
@@ -121,30 +180,10 @@ async def authenticate(req: Request, code: str = None, state: str = None):
     if not OAUTH_ENABLED:
         raise HTTPException(501, "OAuth is not enabled.")
 
+    expire_states()
     if not (code and state) or state not in app.state.states:
-        value = os.urandom(4).hex()
-        if value in app.state.states:
-            log.warning("Generated a state that already exists. Cleaning up")
-            # remove any states older than 5 minutes
-            removed = 0
-            for _value in list(app.state.states):
-                if (datetime.now() - app.state.states[_value]).total_seconds() > 300:
-                    del app.state.states[_value]
-                    removed += 1
-            value = os.urandom(4).hex()
-            log.warning(f"Removed {removed} old states.")
-
-        if value in app.state.states:
-            log.critical("Generated a state that already exists and could not free any slots.")
-            raise HTTPException(
-                HTTPStatus.SERVICE_UNAVAILABLE,
-                "Could not generate a state token (state container full, potential (D)DOS attack?). "
-                "Please try again later.",
-                # Saying a suspected DDOS makes sense, there are 4,294,967,296 possible states, the likelyhood of a
-                # collision is 1 in 4,294,967,296.
-                headers={"Retry-After": "60"},
-            )
-        app.state.states[value] = datetime.now()
+        value = os.urandom(16).hex()
+        app.state.states[value] = time.monotonic()
         return RedirectResponse(
             discord.utils.oauth_url(
                 OAUTH_ID, redirect_uri=OAUTH_REDIRECT_URI, scopes=("identify", "connections", "guilds", "email")
@@ -173,7 +212,7 @@ async def authenticate(req: Request, code: str = None, state: str = None):
         # Now send a request to https://ip-api.com/json/{ip}?fields=status,city,zip,lat,lon,isp,query
         _host = ipaddress.ip_address(req.client.host)
         if not any((_host.is_loopback, _host.is_private, _host.is_reserved, _host.is_unspecified)):
-            response = app.state.http.get(
+            response = await app.state.http.get(
                 f"http://ip-api.com/json/{req.client.host}?fields=status,city,zip,lat,lon,isp,query,proxy,hosting"
             )
             if response.status_code != 200:
@@ -189,27 +228,9 @@ async def authenticate(req: Request, code: str = None, state: str = None):
 
         # Now we can update the student entry with this data
         await student.update(ip_info=data, access_token_hash=token)
-        document = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Redirecting...</title>
-</head>
-<body>
-    <script>
-        window.location.href = "{GENERAL}";
-    </script>
-    <noscript>
-        <meta http-equiv="refresh" content="0; url={GENERAL}" />
-    </noscript>
-    <p>Redirecting you to the general channel...</p>
-    <i><a href='{GENERAL}' rel='noopener'>Click here if you are not redirected.</a></i>
-</body>
-</html>
-"""
         # And set it as a cookie
         response = HTMLResponse(
-            document, status_code=200, headers={"Location": GENERAL, "Cache-Control": "max-age=604800"}
+            AUTH_REDIRECT_HTML, status_code=200, headers={"Location": GENERAL, "Cache-Control": "max-age=604800"}
         )
         # set the cookie for at most 604800 seconds - expire after that
         response.set_cookie(
@@ -226,7 +247,21 @@ async def authenticate(req: Request, code: str = None, state: str = None):
 async def bridge(req: Request):
     now = datetime.utcnow()
     ts_diff = (now - app.state.last_sender_ts).total_seconds()
-    body = await req.json()
+    try:
+        content_length = int(req.headers.get("Content-Length", 0))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length.")
+    if content_length < 0:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length.")
+    if content_length > BRIDGE_MAX_BODY:
+        raise HTTPException(status_code=413, detail="Request body too large.")
+    # Content-Length may be missing (chunked requests), so stop reading as soon as the limit is passed too
+    raw_body = bytearray()
+    async for chunk in req.stream():
+        raw_body += chunk
+        if len(raw_body) > BRIDGE_MAX_BODY:
+            raise HTTPException(status_code=413, detail="Request body too large.")
+    body = orjson.loads(raw_body)
 
     room_id = body.get("room")
     if not room_id:
@@ -244,12 +279,7 @@ async def bridge(req: Request):
 
     if len(body["message"]) > 4000:
         raise HTTPException(status_code=400, detail="Message too long. 4000 characters maximum.")
-    paginator = Paginator(prefix="", suffix="", max_size=1990)
-    for line in body["message"].splitlines():
-        try:
-            paginator.add_line(line)
-        except ValueError:
-            paginator.add_line(textwrap.shorten(line, width=1980, placeholder="<...>"))
+    paginator = line_paginator(body["message"], max_size=1990)
     if len(paginator.pages) > 1:
         msg = None
         if app.state.last_sender != body["sender"] or ts_diff >= 600:
@@ -275,38 +305,52 @@ async def bridge(req: Request):
 
 
 @app.websocket("/bridge/recv")
-async def bridge_recv(ws: WebSocket, secret: str = Query(None)):
+async def bridge_recv(ws: WebSocket, secret: str = Query(None), batch: bool = Query(False)):
     await ws.accept()
     log.info("Websocket %s:%s accepted.", ws.client.host, ws.client.port)
-    if secret != app.state.bot.http.token:
+    if not is_bot_token(secret):
         log.warning("Closing websocket %r, invalid secret.", ws.client.host)
         raise _WSException(code=1008, reason="Invalid Secret")
     if app.state.ws_connected.locked():
         log.warning("Closing websocket %r, already connected." % ws)
         raise _WSException(code=1008, reason="Already connected.")
     queue: asyncio.Queue = app.state.bot.bridge_queue
+    # Payloads taken off the queue but not sent yet. Anything left here when a websocket disconnects is sent first
+    # to the next one, so nothing is lost.
+    pending: list = app.state.bridge_pending
 
     async with app.state.ws_connected:
         while True:
-            try:
-                await ws.send_json({"status": "ping"})
-            except (WebSocketDisconnect, WebSocketException):
-                log.info("Websocket %r disconnected.", ws)
-                break
-
-            try:
-                data = await asyncio.wait_for(queue.get(), timeout=5)
-            except asyncio.TimeoutError:
-                continue
+            if not pending:
+                try:
+                    pending.extend(await drain_batch(queue, timeout=5))
+                except asyncio.TimeoutError:
+                    # Nothing to send, so keep the connection alive (and notice if it has gone away) with a ping.
+                    try:
+                        await ws.send_json({"status": "ping"})
+                    except (WebSocketDisconnect, WebSocketException):
+                        log.info("Websocket %r disconnected.", ws)
+                        break
+                    continue
 
             try:
-                await ws.send_json(data)
-                log.debug("Sent data %r to websocket %r.", data, ws)
+                if batch:
+                    # The payloads are already-serialised JSON objects, so they can be joined into an array as-is.
+                    data = b"[" + b",".join(pending) + b"]"
+                    await ws.send_text(data.decode("utf-8"))
+                    log.debug("Sent data %r to websocket %r.", data, ws)
+                    for _ in pending:
+                        queue.task_done()
+                    pending.clear()
+                else:
+                    while pending:
+                        await ws.send_text(pending[0].decode("utf-8"))
+                        log.debug("Sent data %r to websocket %r.", pending[0], ws)
+                        del pending[0]
+                        queue.task_done()
             except (WebSocketDisconnect, WebSocketException):
                 log.info("Websocket %r disconnected." % ws)
                 break
-            finally:
-                queue.task_done()
 
 
 @app.get("/bridge/bind/new", dependencies=[Depends(is_authenticated)])
@@ -344,14 +388,14 @@ async def bridge_bind_callback(code: str, state: str):
     user = await get_authorised_user(access_token,)
     user_id = int(user["id"])
     await BridgeBind.objects.create(matrix_id=mx_id, discord_id=user_id)
-    return JSONResponse({"success": True, "matrix": mx_id, "discord": user_id}, 201)
+    return ORJSONResponse({"success": True, "matrix": mx_id, "discord": user_id}, 201)
 
 
 @app.post("/bridge/bind/_create", include_in_schema=False, dependencies=[Depends(is_authenticated)])
 async def bridge_bind_create_nonuser(
     req: Request
 ):
-    body = await req.json()
+    body = orjson.loads(await req.body())
     if "mx_id" not in body or "discord_id" not in body:
         raise HTTPException(400, "Missing fields")
     mx_id = body["mx_id"]
@@ -361,7 +405,7 @@ async def bridge_bind_create_nonuser(
     if existing:
         raise HTTPException(409, "Target already bound")
     await BridgeBind.objects.create(matrix_id=mx_id, discord_id=discord_id, webhook=webhook)
-    return JSONResponse({"status": "ok"}, 201)
+    return ORJSONResponse({"status": "ok"}, 201)
 
 
 @app.delete("/bridge/bind/{mx_id}")
@@ -379,7 +423,7 @@ async def bridge_bind_delete(mx_id: str, code: str = None, state: str = None):
             redirect_uri=BIND_REDIRECT_URI,
             scopes=("identify",)
         ) + f"&state={token}&prompt=none"
-        return JSONResponse({"status": "pending", "url": url})
+        return ORJSONResponse({"status": "pending", "url": url})
     else:
         access_token = await get_access_token(code, redirect_uri=BIND_REDIRECT_URI)
         user = await get_authorised_user(access_token)
@@ -389,7 +433,7 @@ async def bridge_bind_delete(mx_id: str, code: str = None, state: str = None):
         if real_mx_id != mx_id:
             raise HTTPException(400, "Invalid state")
         await existing.delete()
-        return JSONResponse({"status": "ok"}, 200)
+        return ORJSONResponse({"status": "ok"}, 200)
 
 
 @app.get("/bridge/bind/{mx_id}", dependencies=[Depends(is_authenticated)])
@@ -401,4 +445,4 @@ async def bridge_bind_fetch(mx_id: str):
     payload = {"discord": existing.discord_id, "matrix": mx_id}
     if existing.webhook:
         payload["webhook"] = existing.webhook
-    return JSONResponse(payload, 200)
+    return ORJSONResponse(payload, 200)